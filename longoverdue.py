@@ -1,26 +1,28 @@
 #!/usr/bin/env python3
 
-import locale
+import concurrent.futures
+import functools
 import os
-import re
+import pwd
 import subprocess
 import sys
 
-import click
-
 # List of services not to restart automatically
 NO_AUTORESTART = {"dbus.service": "reboot required",
         "systemd-logind.service": "will log all users out"}
 
-FILE_BLACKLIST = []
-EXT_BLACKLIST = [".cache", ".gresource"]
-
-PATH_REGEX = re.compile(r"^(?P<path>.*?)(?: \((?:(?:path dev=(?P<devmajor>\d+),(?P<devminor>\d+)|deleted))\))?$")
+FILE_BLACKLIST = frozenset()
+EXT_BLACKLIST = frozenset((".cache", ".gresource"))
 
-locale_encoding = locale.nl_langinfo(locale.CODESET)
 euid = os.geteuid()
 
+# Don't emit escape sequences when piped, or when asked not to
+USE_COLOR = sys.stdout.isatty() and not os.environ.get("NO_COLOR")
+
+@functools.lru_cache(maxsize=None)
 def color(c, bold = False):
+    if not USE_COLOR:
+        return ""
     ret = "\x1b[0;"
     if c >= 0:
         ret += ";38;5;{}".format(c)
@@ -29,88 +31,134 @@ def color(c, bold = False):
     ret += "m"
     return ret
 
-def decode_nuld(nuld):
-    return dict((i[0], i[1:]) for i in nuld.strip("\0").split("\0"))
+C_RESET = color(-1)
+C_BW = color(15, True)
+C_W = color(15)
+C_BLU = color(12, True)
+C_Y = color(3)
 
 class Process:
-    def __init__(self, proc):
-        self.pid = proc.get("p")
-        self.parent = proc.get("R")
-        self.command = proc.get("c")
-        self.uid = proc.get("u")
-        self.gid = proc.get("g")
-        self.user = proc.get("L")
+    __slots__ = ("pid", "command", "user", "unit", "uunit", "files")
+
+    def __init__(self, pid, command, user):
+        self.pid = pid
+        self.command = command
+        self.user = user
         self.unit = None
         self.uunit = None
         self.files = []
 
 class File:
-    def __init__(self, f):
-        self.fd = f.get("f")
-        self.mode = f.get("a")
-        self.lock = f.get("l")
-        self.type = f.get("t")
-        self.dev = f.get("D")
-        self.inode = f.get("i")
-        self.name = re.match(PATH_REGEX, f.get("n"))["path"]
+    __slots__ = ("name",)
 
-def getprocs(pids=None):
-    # Get and parse a list of processes that have deleted file handles
-    lsof = subprocess.run(["lsof", "-dDEL", "-F0"],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.DEVNULL,
-            check=True)
-    procs = []
-    for l in lsof.stdout.decode(locale_encoding).splitlines():
-        if l[0] == "p":
-            if procs and not procs[-1].files:
-                procs.pop()
-            procs.append(Process(decode_nuld(l)))
-        elif l[0] == "f":
-            f = File(decode_nuld(l))
+    def __init__(self, name):
+        # Strip the " (deleted)" suffix from maps
+        if name.endswith(" (deleted)"):
+            self.name = name[:-10]
+        else:
+            self.name = name
+
+def cgroup_units(path):
+    # Same logic as ps's unit and uunit columns: skip slices, the first unit is
+    # the system unit, and the next one is the user unit if it's a user manager
+    units = [c for c in path.split("/") if c and not c.endswith(".slice")]
+    unit = units[0] if units and "." in units[0] else "-"
+    uunit = "-"
+    if unit.startswith("user@") and len(units) > 1 and "." in units[1]:
+        uunit = units[1]
+    return unit, uunit
+
+def read_units(pid):
+    # Prefer the named systemd hierarchy on v1, otherwise the unified one
+    paths = {}
+    with open(f"/proc/{pid}/cgroup", encoding="utf-8",
+            errors="backslashreplace") as f:
+        for l in f:
+            _, controllers, path = l.rstrip("\n").split(":", 2)
+            paths[controllers] = path
+    return cgroup_units(paths.get("name=systemd", paths.get("", "")))
+
+def read_proc(pid):
+    try:
+        return read_proc_files(pid)
+    except (FileNotFoundError, ProcessLookupError, PermissionError):
+        # The process exited or isn't ours to look at
+        return None
+
+def read_proc_files(pid):
+    # Deleted mappings show up in maps with a " (deleted)" suffix. Paths and
+    # process names can hold any bytes, so escape the odd ones like lsof does
+    files = {}
+    with open(f"/proc/{pid}/maps", encoding="utf-8",
+            errors="backslashreplace") as maps:
+        for l in maps:
+            # Cheap check on the raw line before splitting it and building a File
+            if not l.endswith(" (deleted)\n") or " /usr" not in l:
+                continue
+            n = l.split(None, 5)[5].rstrip("\n")
+            if n in files:
+                continue
+            f = File(n)
             if not f.name.startswith("/usr"):
                 continue
-            if os.path.basename(f.name) in FILE_BLACKLIST:
+            # Like os.path.basename and splitext, without going through them
+            base = f.name[f.name.rfind("/") + 1:]
+            if base in FILE_BLACKLIST:
                 continue
-            if os.path.splitext(f.name)[1] in EXT_BLACKLIST:
+            # Leading dots don't start an extension
+            stem = base.lstrip(".")
+            dot = stem.rfind(".")
+            if dot > 0 and stem[dot:] in EXT_BLACKLIST:
                 continue
-            procs[-1].files.append(f)
-    if procs and not procs[-1].files:
-        procs.pop()
-
-    if pids:
-        procs = [p for p in procs if p.pid in pids]
-
-    # Find the systemd unit each process belongs to
-    pids = [p.pid for p in procs]
-    units = subprocess.run(["ps", "-o", "unit=,uunit="] + pids,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.DEVNULL,
-            check=True)
-    units = (l.split() for l in units.stdout.decode(locale_encoding).splitlines())
-    for proc, (unit, uunit) in zip(procs, units):
-        proc.unit = unit
-        proc.uunit = uunit
+            files[n] = f
+    if not files:
+        return None
+
+    status = {}
+    with open(f"/proc/{pid}/status", encoding="utf-8",
+            errors="backslashreplace") as f:
+        for l in f:
+            key, _, value = l.partition(":")
+            status[key] = value.strip()
+    # Owner by effective UID, like lsof and pgrep -u
+    uid = status["Uid"].split()[1]
+    try:
+        user = pwd.getpwuid(int(uid)).pw_name
+    except KeyError:
+        user = uid
+    proc = Process(pid, status["Name"], user)
+    proc.files = list(files.values())
+    proc.unit, proc.uunit = read_units(pid)
 
-    return procs
+    return proc
 
-@click.group(invoke_without_command=True)
-@click.pass_context
-@click.option("-v", "--verbose", count=True)
-def main(ctx, verbose):
-    """Manage running services that need updating"""
-    if ctx.invoked_subcommand is None:
-        list_()
+def getprocs(pids=None):
+    # Get a list of processes that have deleted file handles, straight from
+    # /proc rather than by forking lsof and ps to parse it for us
+    if not pids:
+        pids = [e.name for e in os.scandir("/proc") if e.name.isdigit()]
+    # Each process is a handful of small reads that block in the kernel, so
+    # overlap them across threads
+    procs = []
+    workers = min(32, (os.cpu_count() or 1) * 4)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(read_proc, pid) for pid in pids]
+        for future in concurrent.futures.as_completed(futures):
+            proc = future.result()
+            if proc is not None:
+                procs.append(proc)
+    return procs
 
-@main.command("list")
-@click.option("-v", "--verbose", count=True)
-def list_(verbose):
+def list_(verbose=0):
     """List running outdated processes"""
+    # Collect the output and write it in one go
+    out = []
+
     kernel = os.uname().release
     if not os.path.exists(f"/usr/lib/modules/{kernel}"):
-        print(f"{color(15, True)}The running kernel ({kernel}) was not found in"
-                f" the file system, it may have been updated{color(-1)}")
-        print()
+        out.append(f"{C_BW}The running kernel ({kernel}) was not found in"
+                f" the file system, it may have been updated{C_RESET}")
+        out.append("")
 
     procs = getprocs()
 
@@ -132,36 +180,38 @@ def list_(verbose):
             others[p.user].append(p)
 
     def warn(desc):
-        print(f"{color(15, True)}The following {desc} "
-                f"{color(15, True)}may be running outdated code:{color(-1)}")
+        out.append(f"{C_BW}The following {desc} "
+                f"{C_BW}may be running outdated code:{C_RESET}")
 
     def item(name, files, warning=""):
-        if warning != "":
-            warning = f" {color(3)}({warning}){color(-1)}"
-        print(f"{color(15)}•{color(-1)} {name}{warning}")
+        if warning:
+            warning = f" {C_Y}({warning}){C_RESET}"
+        out.append(f"{C_W}•{C_RESET} {name}{warning}")
         if verbose:
             for f in files:
-                print(f"  {color(15)}•{color(-1)} {f.name}")
+                out.append(f"  {C_W}•{C_RESET} {f.name}")
 
     if services:
         warn("services")
-        for p in sorted(set(services), key=lambda p: p.unit):
+        for p in sorted(services, key=lambda p: (p.unit, p.command, int(p.pid))):
             item(f"{p.unit} ({p.command} ({p.pid}))", p.files, NO_AUTORESTART.get(p.unit, ""))
-        print()
+        out.append("")
 
     for user, units in uunits.items():
-        warn(f"units for user {color(12, True)}{user}")
-        for p in sorted(set(units), key=lambda p: p.uunit):
+        warn(f"units for user {C_BLU}{user}")
+        for p in sorted(units, key=lambda p: (p.uunit, p.command, int(p.pid))):
             item(f"{p.uunit} ({p.command} ({p.pid}))", p.files)
-        print()
+        out.append("")
 
     for user, procs in others.items():
-        warn(f"processes for user {color(12, True)}{user}")
-        for p in sorted(set(procs), key=lambda p: p.command):
+        warn(f"processes for user {C_BLU}{user}")
+        for p in sorted(procs, key=lambda p: (p.command, int(p.pid))):
             item(f"{p.command} ({p.pid})", p.files)
-        print()
+        out.append("")
+
+    if out:
+        sys.stdout.write("\n".join(out) + "\n")
 
-@main.command()
 def restart():
     """Restart outdated services"""
     procs = getprocs()
@@ -201,37 +251,64 @@ def restart():
         except subprocess.CalledProcessError:
             sys.exit(1)
 
-@main.command()
-@click.argument("regex")
 def info(regex):
     """Get details on a process"""
     prgrep = ["pgrep", regex]
     if euid != 0:
         prgrep.extend(["-u", str(euid)])
     try:
-        pids = subprocess.run(prgrep, stdout=subprocess.PIPE, check=True)
+        pids = subprocess.run(prgrep, stdout=subprocess.PIPE, check=True,
+                text=True, encoding="utf-8", errors="surrogateescape")
     except subprocess.CalledProcessError:
-        print(f"{color(15, True)}No process matched {color(12, True)}{regex}"
-                f"{color(15, True)}.{color(-1)}")
+        print(f"{C_BW}No process matched {C_BLU}{regex}"
+                f"{C_BW}.{C_RESET}")
         sys.exit(1)
-    pids = [pid.strip() for pid in pids.stdout.decode(locale_encoding).splitlines()]
+    pids = [pid.strip() for pid in pids.stdout.splitlines()]
 
     try:
         procs = getprocs(pids)
-    except subprocess.CalledProcessError:
+    except OSError:
         print("Couldn't retrieve process info.")
         sys.exit(1)
 
     files = sorted(set((f.name for p in procs for f in p.files)))
 
+    out = []
     if files:
-        print(f"{color(12, True)}{regex}{color(15, True)} is using the "
-                f"following outdated binaries:{color(-1)}")
+        out.append(f"{C_BLU}{regex}{C_BW} is using the "
+                f"following outdated binaries:{C_RESET}")
         for f in files:
-            print(f"{color(15)}•{color(-1)} {f}")
+            out.append(f"{C_W}•{C_RESET} {f}")
+    else:
+        out.append(f"{C_BLU}{regex}{C_BW} appears to be "
+                f"running updated binaries.{C_RESET}")
+    sys.stdout.write("\n".join(out) + "\n")
+
+def cli():
+    import click
+
+    @click.group(invoke_without_command=True)
+    @click.pass_context
+    @click.option("-v", "--verbose", count=True)
+    def group(ctx, verbose):
+        """Manage running services that need updating"""
+        if ctx.invoked_subcommand is None:
+            list_(verbose)
+
+    group.command("list")(click.option("-v", "--verbose", count=True)(list_))
+    group.command("restart")(restart)
+    group.command("info")(click.argument("regex")(info))
+    group()
+
+def main():
+    # Importing click dominates startup, so skip it for the common invocations
+    args = sys.argv[1:]
+    if args in ([], ["list"]):
+        list_()
+    elif args == ["restart"]:
+        restart()
     else:
-        print(f"{color(12, True)}{regex}{color(15, True)} appears to be "
-                f"running updated binaries.{color(-1)}")
+        cli()
 
 if __name__ == "__main__":
     main()